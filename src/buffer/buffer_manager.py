@@ -1,87 +1,102 @@
 from pathlib import Path
-from typing import List
-import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
-import os
 
 
 class EmailBufferManager:
-    def __init__(self, batch_size: int, output_path: Path, use_streaming: bool = False):
-        self.buffer = []
+    def __init__(self, batch_size: int, output_path: Path, row_group_size: int = 8192):
+        self.buffer: list[pa.RecordBatch] = []
+        self.buffered_rows = 0
         self.batch_size = batch_size
+        # Each flushed batch is split into row groups of this size, keeping them small enough to decode in cache.
+        self.row_group_size = row_group_size
         self.output_path = output_path
-        self.schema = None
-        self.use_streaming = use_streaming
+        self.schema = pa.schema([
+            pa.field("email_hash", pa.string()),
+            pa.field("group_id", pa.int64()),
+            pa.field("subject", pa.string()),
+            pa.field("date", pa.timestamp("us", tz="UTC")),
+            pa.field("norm_date", pa.timestamp("us", tz="UTC")),
+            pa.field("sender_id", pa.int64()),
+            pa.field("parent_hash", pa.string()),
+        ])
         self.parquet_writer = None
         # Ensure the output directory exists
         self.output_path.parent.mkdir(exist_ok=True, parents=True)
+        # A table left over from a previous run is removed up front, as the writer only replaces it on the first flush;
+        # a run that yields no emails would otherwise leave the stale table behind for post-processing.
+        self.output_path.unlink(missing_ok=True)
 
-    def add_emails(self, emails: List[dict]):
+    def add_batch(self, batch: pa.RecordBatch):
         """
-        Adds a list of email dictionaries to the buffer.
+        Adds a record batch of emails to the buffer. Only the columns of the email table are kept.
         If the buffer exceeds the batch size, it triggers a flush.
         """
-        self.buffer.extend(emails)
-        if len(self.buffer) >= self.batch_size:
+        self.buffer.append(batch.select(self.schema.names))
+        self.buffered_rows += batch.num_rows
+        if self.buffered_rows >= self.batch_size:
             self.flush()
 
     def flush(self):
         """
         Writes the current buffer to the Parquet file and clears it.
-        Crucially, it appends to the file if it already exists.
+        A single writer is kept open for the whole job, so each flush appends a row group instead of rewriting the
+        file. The writer is created lazily on the first flush.
         """
         if not self.buffer:
             return
 
-        df = pd.DataFrame(self.buffer)
-        table = pa.Table.from_pandas(df)
+        # The buffered batches already share the table's schema, so they are combined without copying.
+        table = pa.Table.from_batches(self.buffer, schema=self.schema)
 
-        if self.use_streaming:
-            # Use streaming writer for better performance
-            if self.parquet_writer is None:
-                self.schema = table.schema
-                self.parquet_writer = pq.ParquetWriter(self.output_path, self.schema)
-
-            self.parquet_writer.write_table(table)
-        else:
-            # Use read-combine-write approach
-            if os.path.exists(self.output_path):
-                # If the file exists, read existing data and append
-                existing_table = pq.read_table(self.output_path)
-
-                # Ensure schemas are compatible
-                if self.schema is None:
-                    self.schema = existing_table.schema
-
-                # Combine tables
-                combined_table = pa.concat_tables([existing_table, table])
-
-                # Write the combined data back
-                pq.write_table(combined_table, self.output_path)
-            else:
-                # If it's the first write, create the file
-                self.schema = table.schema
-                pq.write_table(table, self.output_path)
+        self._open_writer()
+        self.parquet_writer.write_table(table, row_group_size=self.row_group_size)
 
         # Clear the buffer after writing
-        records_written = len(df)
+        records_written = table.num_rows
         self.buffer.clear()
+        self.buffered_rows = 0
         print(f"Flushed {records_written} records to {self.output_path}")
 
+    def _open_writer(self):
+        """
+        Creates the writer if it is not open yet.
+        """
+        if self.parquet_writer is None:
+            # Dictionary encoding only pays off on columns with repeated values; email_hash is unique per row.
+            self.parquet_writer = pq.ParquetWriter(self.output_path, self.schema, compression="zstd",
+                                                   compression_level=3,
+                                                   use_dictionary=["group_id", "subject", "sender_id", "parent_hash"])
+
     def finalize(self):
         """
-        Flushes any remaining data in the buffer.
+        Flushes any remaining data in the buffer and closes the writer. If nothing was flushed, an empty table with the
+        email schema is written, so post-processing still finds a table from this run.
         """
         self.flush()
-        if self.parquet_writer:
-            self.parquet_writer.close()
-            self.parquet_writer = None
+        self._open_writer()
+        self.parquet_writer.close()
+        self.parquet_writer = None
 
     def __enter__(self):
         """Context manager entry"""
         return self
 
+    def discard(self):
+        """
+        Drops the buffered emails and removes the partially written table, so a failed run does not leave a truncated
+        table that looks valid.
+        """
+        self.buffer.clear()
+        self.buffered_rows = 0
+        if self.parquet_writer:
+            self.parquet_writer.close()
+            self.parquet_writer = None
+        self.output_path.unlink(missing_ok=True)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Context manager exit - ensures final flush"""
-        self.finalize()
\ No newline at end of file
+        """Context manager exit - ensures final flush, or discards the table if an exception is propagating"""
+        if exc_type is not None:
+            self.discard()
+        else:
+            self.finalize()
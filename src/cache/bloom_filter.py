@@ -0,0 +1,79 @@
+from multiprocessing import shared_memory
+
+
+class SharedBloomFilter:
+    """
+    A Bloom filter whose bit array lives in shared memory, allowing every worker process to test and set the same
+    filter directly rather than routing each lookup through a manager process.
+
+    The bit positions are derived from the 128-bit digest itself by double hashing (the low and high 64 bits), so no
+    additional hashing is performed. Test-and-set is not atomic across processes; two workers racing on the same
+    digest may both see it as new, which at worst lets a duplicate through.
+
+    :ivar bit_count: The number of bits in the filter.
+    :type bit_count: int
+    :ivar hash_count: The number of bit positions set per digest.
+    :type hash_count: int
+    """
+    def __init__(self, name: str | None = None, size: int = 16 * 1024 * 1024, hash_count: int = 7):
+        """
+        Creates a new zeroed filter of the given size in bytes, or attaches to an existing one when a name is given.
+        The default of 128 Mbit and 7 positions keeps false positives far below 1e-4 for a few million digests.
+        """
+        # Only the process that created the block frees it.
+        self._owner = name is None
+        if name is None:
+            self._shm = shared_memory.SharedMemory(create=True, size=size)
+            self._shm.buf[:] = bytes(size)
+        else:
+            self._shm = shared_memory.SharedMemory(name=name)
+        self._bits = self._shm.buf
+        self.bit_count = len(self._bits) * 8
+        self.hash_count = hash_count
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def test_and_set(self, hex_digest: str) -> bool:
+        """
+        Marks a 128-bit hex digest as seen.
+        :param hex_digest: The digest to test, e.g. from xxhash.xxh3_128_hexdigest.
+        :return: True if the digest was (probably) already present, False if it is new.
+        """
+        value = int(hex_digest, 16)
+        h1 = value & 0xFFFFFFFFFFFFFFFF
+        h2 = (value >> 64) | 1
+        present = True
+        for i in range(self.hash_count):
+            position = (h1 + i * h2) % self.bit_count
+            index = position >> 3
+            mask = 1 << (position & 7)
+            byte = self._bits[index]
+            if not byte & mask:
+                present = False
+                self._bits[index] = byte | mask
+        return present
+
+    def close(self):
+        """
+        Detaches this process from the shared memory block.
+        """
+        self._bits = None
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Frees the shared memory block. Only the creating process should call this, after all workers are done.
+        """
+        self._shm.unlink()
+
+    def __enter__(self):
+        """Context manager entry"""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Context manager exit - detaches, and frees the block if this process created it, even if a run failed"""
+        self.close()
+        if self._owner:
+            self.unlink()
@@ -0,0 +1,113 @@
+import mmap
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, Tuple
+
+import pyarrow as pa
+
+
+class CanonCache:
+    """
+    An append-only on-disk cache of canonicalized emails, so that re-runs can skip reading, filtering and decoding the
+    raw files again.
+
+    Entries are LZ4 frames stored back to back in a single data file. An index mapping each source path to
+    (offset, length, canonical size, mtime) is pickled next to it when the cache is closed; an entry is only used if
+    the source file's mtime still matches. The index also records the format tag it was written with, and the whole
+    cache is discarded when the tag no longer matches, so a change to the canonicalization never replays stale bytes.
+    Entries from previous runs are read through a memory map, which is safe to slice from the reader threads. Only the
+    main process appends to the cache.
+
+    :ivar index: The source path of each cached email mapped to (offset, length, canonical size, mtime in ns).
+    :type index: Dict[str, Tuple[int, int, int, int]]
+    :ivar format_tag: Identifies how the cached bytes were produced.
+    :type format_tag: str
+    """
+    def __init__(self, data_path: Path, format_tag: str):
+        """
+        :param data_path: The data file; the index is stored next to it with an .idx suffix.
+        :param format_tag: Identifies how the cached bytes are produced. Entries written under another tag are dropped.
+        """
+        self.data_path = data_path
+        self.index_path = data_path.with_suffix(".idx")
+        self.format_tag = format_tag
+        self.index: Dict[str, Tuple[int, int, int, int]] = {}
+        self.data_path.parent.mkdir(exist_ok=True, parents=True)
+
+        stored = None
+        if self.data_path.exists() and self.index_path.exists():
+            with open(self.index_path, "rb") as index_file:
+                stored = pickle.load(index_file)
+        # Indexes from before the tag was stored are a plain dict, and never match.
+        if isinstance(stored, tuple) and stored[0] == format_tag:
+            self.index = stored[1]
+        else:
+            # Without a matching index the existing data cannot be located or trusted, so start over.
+            self.data_path.unlink(missing_ok=True)
+
+        self._append_file = open(self.data_path, "ab")
+        self._offset = self._append_file.tell()
+        self._read_file = None
+        self._map = None
+        if self._offset:
+            self._read_file = open(self.data_path, "rb")
+            self._map = mmap.mmap(self._read_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def pack(canon_bytes: bytes) -> bytes:
+        """
+        Compresses canonical email bytes into an LZ4 frame for storage.
+        """
+        return pa.compress(canon_bytes, codec="lz4", asbytes=True)
+
+    @staticmethod
+    def unpack(packed: bytes, canon_size: int) -> bytes:
+        """
+        Restores canonical email bytes from a stored LZ4 frame.
+        """
+        return pa.decompress(packed, decompressed_size=canon_size, codec="lz4", asbytes=True)
+
+    def get(self, path_key: str, mtime_ns: int) -> tuple[bytes, int] | None:
+        """
+        Looks up a file from a previous run.
+        :return: The packed canonical bytes and their unpacked size, or None if the file is not cached or has changed.
+        """
+        entry = self.index.get(path_key)
+        if entry is None or self._map is None:
+            return None
+        offset, length, canon_size, cached_mtime_ns = entry
+        if cached_mtime_ns != mtime_ns or offset + length > len(self._map):
+            return None
+        return self._map[offset:offset + length], canon_size
+
+    def put(self, path_key: str, mtime_ns: int, packed: bytes, canon_size: int):
+        """
+        Appends a packed canonical email to the data file and records it in the index.
+        """
+        self._append_file.write(packed)
+        self.index[path_key] = (self._offset, len(packed), canon_size, mtime_ns)
+        self._offset += len(packed)
+
+    def close(self):
+        """
+        Closes the data file and persists the index. The index is written to a temporary file first, so an interrupted
+        write never leaves a truncated index behind.
+        """
+        if self._map is not None:
+            self._map.close()
+            self._read_file.close()
+            self._map = None
+        self._append_file.close()
+        temp_index_path = self.index_path.with_suffix(".idx.tmp")
+        with open(temp_index_path, "wb") as index_file:
+            pickle.dump((self.format_tag, self.index), index_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_index_path, self.index_path)
+
+    def __enter__(self):
+        """Context manager entry"""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Context manager exit - persists the index"""
+        self.close()
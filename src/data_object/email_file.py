@@ -0,0 +1,12 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+
+@dataclass(slots=True)
+class EmailFile:
+    path: Path
+    mtime_ns: int
+    # The raw file contents, or a packed canonical entry from the cache when canon_size is set. None if unreadable.
+    contents: Optional[bytes]
+    canon_size: Optional[int] = None
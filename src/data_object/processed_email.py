@@ -1,9 +1,22 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import FrozenSet, Optional
+from typing import FrozenSet, List, Optional
 
+import pyarrow as pa
 
-@dataclass(frozen=True)
+# The columns emitted by the worker processes for each batch of processed emails.
+PROCESSED_EMAIL_SCHEMA = pa.schema([
+    pa.field("email_hash", pa.string()),
+    pa.field("subject", pa.string()),
+    pa.field("date", pa.timestamp("us", tz="UTC")),
+    pa.field("norm_date", pa.timestamp("us", tz="UTC")),
+    pa.field("aliases", pa.list_(pa.string())),
+    pa.field("sender", pa.list_(pa.string())),
+    pa.field("parent_hash", pa.string()),
+])
+
+
+@dataclass(frozen=True, slots=True)
 class ProcessedEmail:
     email_hash: str
     date: datetime
@@ -11,4 +24,20 @@ class ProcessedEmail:
     subject: str
     aliases: FrozenSet[str]
     sender: FrozenSet[str]
-    parent_hash: Optional[str] = None
\ No newline at end of file
+    parent_hash: Optional[str] = None
+
+    @staticmethod
+    def to_record_batch(emails: List["ProcessedEmail"]) -> pa.RecordBatch:
+        """
+        Flattens processed emails into a single record batch, which crosses the process boundary as a few Arrow
+        buffers instead of one pickled object per email.
+        """
+        return pa.record_batch([
+            pa.array([email.email_hash for email in emails], pa.string()),
+            pa.array([email.subject for email in emails], pa.string()),
+            pa.array([email.date for email in emails], pa.timestamp("us", tz="UTC")),
+            pa.array([email.norm_date for email in emails], pa.timestamp("us", tz="UTC")),
+            pa.array([list(email.aliases) for email in emails], pa.list_(pa.string())),
+            pa.array([list(email.sender) for email in emails], pa.list_(pa.string())),
+            pa.array([email.parent_hash for email in emails], pa.string()),
+        ], schema=PROCESSED_EMAIL_SCHEMA)
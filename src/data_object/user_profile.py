@@ -7,5 +7,6 @@ class UserProfile:
     id: int
     first_name: str
     last_name: str
+    initial: str
     generated_aliases: FrozenSet[str]
     aliases: FrozenSet[str]
\ No newline at end of file
@@ -1,6 +1,9 @@
+import functools
 import re
-from typing import Set, Optional, Tuple
+import sys
+from typing import Dict, Iterable, Iterator, Set, Optional, Tuple
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import src.global_utils as global_utils
 from dateutil.parser import parse
 
@@ -10,6 +13,13 @@ TIMEZONE_MAP = {
     'CST': 'America/Chicago',   'CDT': 'America/Chicago',
     'EST': 'America/New_York',    'EDT': 'America/New_York',
 }
+_TZ_ABBREVIATION = re.compile(r'\((\w{3})\)$')
+# The RFC 2822 layout of the parent "Date:" header, e.g. "Mon, 2 Oct 2000 10:30:00 -0700".
+_RFC2822_DATE = re.compile(r"^(?:[A-Za-z]{3},\s+)?\d{1,2}\s+[A-Za-z]{3}\s+\d{4}\s+\d{1,2}:\d{2}(?::\d{2})?\s+[+-]\d{4}$")
+# A header line and any folded continuation lines, within the header block.
+_HEADER = re.compile(r"^([\w-]+):[ \t]*(.*(?:\n[ \t].*)*)", re.MULTILINE)
+# The blank line that ends the header block.
+_HEADER_END = re.compile(r"\n\r?\n")
 
 def _clean_date_string(date_string: str) -> str:
     """
@@ -18,7 +28,7 @@ def _clean_date_string(date_string: str) -> str:
     """
     # The regex looks for a timezone abbreviation in parentheses at the end of the string
     # e.g., "Mon, 2 Oct 2000 10:30:00 -0700 (PDT)" -> captures "PDT"
-    match = re.search(r'\((\w{3})\)$', date_string)
+    match = _TZ_ABBREVIATION.search(date_string)
     if match:
         tz_abbr = match.group(1)
         if tz_abbr in TIMEZONE_MAP:
@@ -28,19 +38,52 @@ def _clean_date_string(date_string: str) -> str:
             return date_string.replace(f'({tz_abbr})', '').strip()
     return date_string
 
-def _extract_users(text, regex) -> Set[str]:
+def _parse_date_string(date_string: str) -> datetime:
+    """
+    Parses a cleaned date string. RFC 2822 dates take the much faster stdlib parser; everything else, such as the
+    free-form "Sent:" dates of child emails, goes through dateutil. The stdlib parser silently ignores AM/PM, which is
+    why it is only trusted for strings in the RFC 2822 layout.
+    :raises ValueError
+    """
+    if _RFC2822_DATE.match(date_string):
+        dt = parsedate_to_datetime(date_string)
+        # A "-0000" offset yields a naive datetime, whereas dateutil treats it as UTC.
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+    return parse(date_string)
+
+def _normalize_aliases(aliases: Iterable[str]) -> Set[str]:
+    """
+    Reformats aliases for user pipeline ingestion, dropping blank ones. A single alias containing many ", " means the
+    user regex failed on a list that uses spaces as the deliminator, e.g. "allen phillip, arnold john", so it is split
+    and the spaces within each name are replaced with ", ".
+    :return: The normalized aliases, interned.
+    """
+    normalized: Set[str] = set()
+    for alias in aliases:
+        if not alias or not alias.strip():
+            continue
+        if alias.count(",") <= 3:
+            normalized.add(alias)
+            continue
+        for alias_ in alias.split(", "):
+            if not alias_.strip():
+                continue
+            normalized.add(sys.intern(alias_ if "@" in alias_ else alias_.replace(" ", ", ")))
+    return normalized
+
+def _extract_users(text, regex: re.Pattern) -> Set[str]:
     """
 
     :param text: The relevant section of text.
-    :param regex: The appropriate regular expression for identifying and separating aliases.
-    :return: Aliases converted into a set.
+    :param regex: The appropriate compiled regular expression for identifying and separating aliases.
+    :return: Aliases converted into a set. The aliases are interned, as the same few are repeated across many emails.
     """
     users = set()
-    users_re = re.match(regex, text)
+    users_re = regex.match(text)
     if not global_utils.is_regex_populated(users_re, "User extraction", text, False, True):
         return users
     for user in users_re.groups():
-        users.add(user)
+        users.add(sys.intern(user))
     return users
 
 def _parse_parent_date(date_string) -> tuple[datetime, datetime] | None:
@@ -53,7 +96,7 @@ def _parse_parent_date(date_string) -> tuple[datetime, datetime] | None:
     """
     try:
         cleaned_date_string = _clean_date_string(date_string)
-        original_dt_aware = parse(cleaned_date_string).astimezone(timezone.utc)
+        original_dt_aware = _parse_date_string(cleaned_date_string).astimezone(timezone.utc)
         normalized_dt_utc = original_dt_aware.astimezone(timezone.utc)
         return original_dt_aware, normalized_dt_utc
 
@@ -73,7 +116,7 @@ def _parse_child_email_date(date_string: str, parent_timezone: timezone) -> Opti
     """
     try:
         cleaned_date_string = _clean_date_string(date_string)
-        dt_naive = parse(cleaned_date_string)
+        dt_naive = _parse_date_string(cleaned_date_string)
         original_dt_aware = dt_naive.replace(tzinfo=parent_timezone)
         normalized_dt_utc = original_dt_aware.astimezone(timezone.utc)
         return original_dt_aware, normalized_dt_utc
@@ -81,40 +124,74 @@ def _parse_child_email_date(date_string: str, parent_timezone: timezone) -> Opti
         raise ValueError(f"Invalid child email date format. Context:\n{date_string}")
 
 
-def _extract_parent_users(email, fields: list[list[str]], regex) -> Tuple[Set[str], str]:
+def _parse_headers(email: str) -> Dict[str, str]:
     """
-    This function is specifically designed for the parent fields of To: From: Cc: And the same with the "X-" prefix.
+    Parses the header block of an email, up to the first blank line, in a single pass. Folded continuation lines are
+    kept as part of the value.
     :param email: The email in text form.
-    :param fields: The boundaries of where to extract text between.
-    :param regex: The regular expression to apply on the result of the text retrieved between the specified boundaries.
-    :return: All aliases and the sender alias.
+    :return: Each header's first value, stripped, keyed by header name.
+    """
+    header_end = _HEADER_END.search(email)
+    end = header_end.start() if header_end else len(email)
+    headers: Dict[str, str] = {}
+    for match in _HEADER.finditer(email, 0, end):
+        headers.setdefault(match.group(1), match.group(2).strip())
+    return headers
+
+def _extract_parent_users(headers: Dict[str, str], fields: list[str], regex: re.Pattern) -> Tuple[Set[str], str]:
+    """
+    This function is specifically designed for the parent fields of To: From: Cc: And the same with the "X-" prefix.
+    :param headers: The parent email's headers, as parsed by _parse_headers.
+    :param fields: The header fields to extract users from.
+    :param regex: The compiled regular expression to apply on each field's value.
+    :return: All aliases and the sender alias, interned.
     """
     aliases: Set[str] = set()
     sender = ""
-    for to, from_ in fields:
-        users_text = _extract_between_fields(email, to, from_)
+    for field in fields:
+        users_text = headers.get(field)
         if not users_text:
             continue
 
-        users_re = re.search(regex, users_text)
-        if to == "From" or to == "X-From":
-            sender = users_re.group(1) if users_re and users_re.groups() else users_text
+        users_re = regex.search(users_text)
+        if field == "From" or field == "X-From":
+            sender = sys.intern(users_re.group(1) if users_re and users_re.groups() else users_text)
             aliases.update(sender)
             continue
         # Expected match is False, as To and Cc aren't always present.
-        if not global_utils.is_regex_populated(users_re, "Extracting parent users", email, False):
+        if not global_utils.is_regex_populated(users_re, "Extracting parent users", users_text, False):
             continue
-        aliases.update(users_re.groups())
+        aliases.update(map(sys.intern, users_re.groups()))
     return aliases, sender
 
+@functools.lru_cache(maxsize=256)
+def _compile_between(start_field: str, end_field: str, multi_line: bool) -> re.Pattern:
+    """
+    Compiles the pattern used by _extract_between_fields once per boundary pair, as the same few pairs are used for
+    every email.
+    """
+    flags = re.DOTALL if multi_line else 0
+    return re.compile(f"(?:{start_field}:\\s*)(.*?)(?:\n{end_field}:)", flags)
+
 def _extract_between_fields(email: str, start_field: str, end_field: str, multi_line: bool = True) -> Optional[str]:
     """
     Extracts content between a start and end header field.
     This is particularly useful for extracting the message body.
     """
-    flags = re.DOTALL if multi_line else 0
-    regex_pattern = f"(?:{start_field}:\\s*)(.*?)(?:\n{end_field}:)"
-    match = re.search(regex_pattern, email, flags=flags)
+    match = _compile_between(start_field, end_field, multi_line).search(email)
     if not global_utils.is_regex_populated(match, f"Extraction between {start_field} and {end_field}", email, False, False):
         return None
     return match.group(1).strip()
+
+def _iter_between(text: str, separator: str, start: int = 0) -> Iterator[str]:
+    """
+    Yields each piece of text between consecutive separators, beginning at start, without building the full split.
+    Any text after the final separator is not yielded.
+    """
+    position = start
+    while True:
+        separator_index = text.find(separator, position)
+        if separator_index == -1:
+            return
+        yield text[position:separator_index]
+        position = separator_index + len(separator)
@@ -1,82 +1,146 @@
-import hashlib
-from typing import Dict, Set, Optional, FrozenSet
+from typing import Iterator, List, Optional, FrozenSet
 from datetime import timezone
 import re
+import sys
+import pyarrow as pa
+import pyarrow.compute as pc
+import xxhash
 from . import _helpers as helpers
 import src.global_utils as global_utils
 
+from src.cache.bloom_filter import SharedBloomFilter
 from src.data_object.processed_email import ProcessedEmail
 
+_PARENT_MSG = re.compile(r"X-bcc:.*?\n(.*)", re.DOTALL)
+_PARENT_DATE = re.compile(r"Date:\s*(.*)\n")
+_CHILD_MSG = re.compile(r"Subject:.*?\n(.*)", re.DOTALL)
+_CHILD_DATE = re.compile(r"(?:Sent|Date):\s*(.*)\n")
+_CHILD_FROM = re.compile(r"From:\s+(.*)$")
+_SUBJECT = re.compile(r"Subject:\s*(.*)\n", re.DOTALL)
+# Used for X-From: X-To: X-cc
+_X_FILTER = re.compile(r"(?:\s*,\s*)?(\w+,\s+.*?(?=\s*<|\.\s*)|[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,6})")
+# Used for From: To: and CC:, parent email only.
+_NON_X_FILTER = re.compile(r"\s*([^,]+@[^,]+)(?=\s*,|$)")
+# Used for child From: To: and CC: fields.
+_CHILD_USER_FILTER = re.compile(r"(?:\s*,\s*)?(\w+,\s+.*?(?=\s*\(|\.|\[|;|'\s*))")
+_CHILD_SEPARATOR = "-----Original Message-----"
+# RE2 equivalents of _PARENT_DATE and _PARENT_MSG, run over a whole batch of parent emails by pyarrow.compute.
+_BATCH_PARENT_DATE = r"Date:\s*(?P<date>.*)\n"
+_BATCH_PARENT_MSG = r"(?s)X-bcc:.*?\n(?P<msg>.*)"
+
 class EmailPipeline:
+    """
+    Extracts the parent and child emails of each file. One pipeline is built per worker process, holding that worker's
+    handle on the shared message cache.
 
-    def __init__(self):
-        self.parent_msg_filter = r"X-bcc:.*?\n(.*)"
-        self.child_msg_filter = r"Subject:.*?\n(.*)"
-        self.child_date_filter = r"(?:Sent|Date):\s*(.*)\n"
-        self.subject_filter = r"Subject:\s*(.*)\n"
-        # Used for X-From: X-To: X-cc
-        self.x_filter = r"(?:\s*,\s*)?(\w+,\s+.*?(?=\s*<|\.\s*)|[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,6})"
-        # Used for From: To: and CC:, parent email only.
-        self.non_x_filter = r"\s*([^,]+@[^,]+)(?=\s*,|$)"
-        # Used for child From: To: and CC: fields.
-        self.child_user_filter = r"(?:\s*,\s*)?(\w+,\s+.*?(?=\s*\(|\.|\[|;|'\s*))"
+    :ivar message_cache: The message cache shared between the worker processes, recording which message hashes have
+        been seen. The file cache only catches identical files, whereas the same child message is quoted in the reply
+        chains of many different files.
+    :type message_cache: SharedBloomFilter
+    """
+    def __init__(self, message_cache: SharedBloomFilter):
+        self.message_cache = message_cache
 
-    def process_file_contents(self, canon_email: str, message_cache: Dict[str, timezone], lock) -> Optional[Set[ProcessedEmail]]:
+    def process_file_contents(self, canon_email: str) -> Optional[List[ProcessedEmail]]:
         """
-        Processes a file's parent and child emails. Additional parameters are required, due to parallel processing.
+        Processes a file's parent and child emails, as a batch of one.
         :param canon_email: The email text in canonical format.
-        :param message_cache: The message cache instance.
-        :param lock: The lock object from the worker pool manager to prevent race-like conditions.
-        :return: A set of processed emails. If all are already cached, None is returned.
+        :return: A list of processed emails, or None if the email failed.
+        """
+        return self.process_batch([canon_email])[0]
+
+    def process_batch(self, canon_emails: List[str]) -> List[Optional[List[ProcessedEmail]]]:
         """
-        email_split = canon_email.split("-----Original Message-----")
-        processed_emails: Set[ProcessedEmail] = set()
-        email_split_size = len(email_split)
+        Processes the emails of many files together. The parent date and message body are extracted for the whole
+        batch by Arrow's regex kernels in a single pass, instead of two Python regex calls per email; any email the
+        kernels cannot match falls back to the per-email regexes. An email that fails is reported and returned as None,
+        so it does not take the rest of the batch down with it.
+        :param canon_emails: The email texts in canonical format.
+        :return: The processed emails of each input, in the same order.
+        """
+        split_emails = [self._split_email(canon_email) for canon_email in canon_emails]
+        parent_emails = pa.array([parent_email for parent_email, _ in split_emails], type=pa.string())
+        dates = pc.extract_regex(parent_emails, _BATCH_PARENT_DATE).to_pylist()
+        msgs = pc.extract_regex(parent_emails, _BATCH_PARENT_MSG).to_pylist()
+
+        results: List[Optional[List[ProcessedEmail]]] = []
+        for (parent_email, child_emails), date, msg in zip(split_emails, dates, msgs):
+            try:
+                results.append(self._process_split_email(
+                    parent_email,
+                    child_emails,
+                    date_string=date["date"] if date else None,
+                    msg=msg["msg"] if msg else None
+                ))
+            except Exception as e:
+                print(f"Exception caught. Details: {e}")
+                results.append(None)
+        return results
 
-        parent_email = canon_email if email_split_size <= 1 else email_split[0]
-        child_emails: set[str] = set() if email_split_size <= 1 else email_split[1:-1]
+    @staticmethod
+    def _split_email(canon_email: str) -> tuple[str, Iterator[str]]:
+        """
+        Splits a file's contents into the parent email and its child emails. The children are found lazily as they are
+        consumed, rather than materializing every segment up front. The text after the last separator is not a child.
+        """
+        first_separator = canon_email.find(_CHILD_SEPARATOR)
+        if first_separator == -1:
+            return canon_email, iter(())
+        parent_email = canon_email[:first_separator]
+        child_emails = helpers._iter_between(canon_email, _CHILD_SEPARATOR, first_separator + len(_CHILD_SEPARATOR))
+        return parent_email, child_emails
 
-        parent_processed_email, parent_timezone = self._process_parent_email(parent_email, message_cache, lock)
+    def _process_split_email(self, parent_email: str, child_emails: Iterator[str], date_string: str | None = None,
+                             msg: str | None = None) -> List[ProcessedEmail]:
+        """
+        Processes a parent email followed by its child emails.
+        :param date_string: The parent date, if already extracted.
+        :param msg: The parent message body, if already extracted.
+        """
+        # Each message hash is only emitted once thanks to the message cache, so a list is enough; a set would hash
+        # every field of every email, including the alias frozensets.
+        processed_emails: List[ProcessedEmail] = []
+        parent_processed_email, parent_timezone = self._process_parent_email(parent_email, date_string, msg)
         parent_hash = processed_emails
         if isinstance(parent_processed_email, ProcessedEmail):
-            processed_emails.add(parent_processed_email)
+            processed_emails.append(parent_processed_email)
             parent_hash = parent_processed_email.email_hash
         for child_email in child_emails:
-            processed_child_email = self._process_child_email(child_email, parent_timezone, message_cache, lock, parent_hash)
+            processed_child_email = self._process_child_email(child_email, parent_timezone, parent_hash)
             if processed_child_email:
-                processed_emails.add(processed_child_email)
+                processed_emails.append(processed_child_email)
         return processed_emails
 
 
-    def _process_parent_email(self, email: str, message_cache, lock) -> tuple[ProcessedEmail, timezone] | tuple[str, timezone]:
+    def _process_parent_email(self, email: str, date_string: str | None = None, msg: str | None = None) -> tuple[ProcessedEmail, timezone] | tuple[str, timezone]:
         """
         The orchestra for managing the parent email only.
         :param email: Parent email, absent of any "---- Original Message ----" objects and text thereafter.
-        :param message_cache: The instance of the message cache.
-        :param lock: Pool manager lock.
+        :param date_string: The date field, if already extracted by process_batch. Otherwise it is searched for here.
+        :param msg: The message body, if already extracted by process_batch. Otherwise it is searched for here.
         :return: ProcessedEmail object and the timezone extracted from the date data. If cached, the hash is returned instead.
         """
-        msg_re = re.search(self.parent_msg_filter, email, flags=re.DOTALL)
-        global_utils.is_regex_populated(msg_re, "Parent email filter", email)
-        msg = msg_re.group(1)
-        msg_hash = hashlib.md5()
-        msg_hash.update(msg.encode("utf-8"))
-        msg_hash = msg_hash.hexdigest()
-        with lock:
-            if msg_hash in message_cache:
-                return msg_hash, message_cache[msg_hash]
-        # Date prefix is different for parent and child emails.
-        date_re = re.search(r"Date:\s*(.*)\n", email)
-        global_utils.is_regex_populated(date_re, "Parent date field", email)
+        if msg is None:
+            msg_re = _PARENT_MSG.search(email)
+            global_utils.is_regex_populated(msg_re, "Parent email filter", email)
+            msg = msg_re.group(1)
+        # Interned, as the parent hash is shared by every child email of the file.
+        msg_hash = sys.intern(xxhash.xxh3_128_hexdigest(msg.encode("utf-8")))
+        if date_string is None:
+            # Date prefix is different for parent and child emails.
+            date_re = _PARENT_DATE.search(email)
+            global_utils.is_regex_populated(date_re, "Parent date field", email)
+            date_string = date_re.group(1)
+        date_obj, norm_date_obj = helpers._parse_parent_date(date_string)
+        # The cache only records whether a message was seen, so the timezone for the children comes from the date.
+        if self.message_cache.test_and_set(msg_hash):
+            return msg_hash, date_obj.tzinfo
         subject_text = helpers._extract_between_fields(email, start_field="Subject", end_field="Mime-Version")
 
-        date_obj, norm_date_obj = helpers._parse_parent_date(date_re.group(1))
-
-        boundaries = [["From", "To"], ["To", "Subject"], ["Cc", "Mime-Version"]]
-        aliases, sender = helpers._extract_parent_users(email, boundaries, self.non_x_filter)
-
-        x_boundaries = [["X-From", "X-To"], ["X-To", "X-cc"], ["X-cc", "X-bcc"]]
-        x_aliases, x_sender = helpers._extract_parent_users(email, x_boundaries, self.x_filter)
+        # The headers are parsed once, rather than searching the whole email for each pair of boundary fields.
+        headers = helpers._parse_headers(email)
+        aliases, sender = helpers._extract_parent_users(headers, ["From", "To", "Cc"], _NON_X_FILTER)
+        x_aliases, x_sender = helpers._extract_parent_users(headers, ["X-From", "X-To", "X-cc"], _X_FILTER)
         senders = [sender, x_sender] if sender else [x_sender] # "From:" is not always present
         senders = frozenset(senders)
 
@@ -85,63 +149,55 @@ class EmailPipeline:
             date=date_obj,
             norm_date=norm_date_obj,
             subject=subject_text,
-            aliases=frozenset({alias for alias in aliases if alias}),
+            aliases=frozenset(helpers._normalize_aliases(aliases)),
             sender=senders,
             parent_hash=""
         )
-        with lock:
-            message_cache[msg_hash] = date_obj.tzinfo
         return processed_email, date_obj.tzinfo
 
 
-    def _process_child_email(self, email: str, parent_timezone: timezone, message_cache, lock, parent_hash: str) -> ProcessedEmail | None:
+    def _process_child_email(self, email: str, parent_timezone: timezone, parent_hash: str) -> ProcessedEmail | None:
         """
         The orchestra for child emails only.
         :param email: Text representing a child email.
         :param parent_timezone: Parent email timezone; it's assumed this and the child email's timezone are consistent.
-        :param message_cache: The message cache instance for querying and updating.
-        :param lock: Lock to access and update message_cache without race-conditions.
         :return: ProcessedEmail objects, or None if all are already cached.
         """
-        msg_re = re.search(self.child_msg_filter, email, flags=re.DOTALL)
-        date_re = re.search(self.child_date_filter, email)
-        subject_re = re.search(self.subject_filter, email, flags = re.DOTALL)
+        msg_re = _CHILD_MSG.search(email)
+        date_re = _CHILD_DATE.search(email)
+        subject_re = _SUBJECT.search(email)
         global_utils.is_regex_populated(date_re, "Child date filter", email)
         # The > character may be used legitimately, but the purpose of this data is not NLP, but quantitative insights. As such,
         # it's more efficient to strip > entirely when used as a prefix of new lines in child messages.
         if not msg_re or not msg_re.groups():
             return None
         msg = msg_re.group(1).strip(">")
-        msg_hash = hashlib.md5()
-        msg_hash.update(msg.encode("utf-8"))
-        msg_hash = msg_hash.hexdigest()
-        with lock:
-            if msg_hash in message_cache:
-                return None
-            message_cache[msg_hash] = parent_timezone
+        msg_hash = sys.intern(xxhash.xxh3_128_hexdigest(msg.encode("utf-8")))
+        if self.message_cache.test_and_set(msg_hash):
+            return None
         date, norm_date = helpers._parse_child_email_date(date_string=date_re.group(1), parent_timezone=parent_timezone)
         subject = None if not (subject_re or subject_re.groups()) else subject_re.group(1)
-        from_text = re.search(r"From:\s+(.*)$", email)
+        from_text = _CHILD_FROM.search(email)
         to_text = helpers._extract_between_fields(email, "To", "Subject")
         users = set()
         from_alias = ""
         if from_text:
             from_alias = helpers._extract_users(
                 text=from_text,
-                regex=self.child_user_filter
+                regex=_CHILD_USER_FILTER
             )
             from_alias = from_text if not from_alias else from_alias
             users.update(from_alias)
         if to_text:
             users.update(helpers._extract_users(
                 text=to_text,
-                regex=self.child_user_filter
+                regex=_CHILD_USER_FILTER
             ))
         return ProcessedEmail(
             email_hash=msg_hash,
             date=date,
             norm_date=norm_date,
             subject=subject,
-            aliases=frozenset({user for user in users if user}),
+            aliases=frozenset(helpers._normalize_aliases(users)),
             sender=frozenset(from_alias)
         )
@@ -41,11 +41,13 @@ class GroupPipeline:
             An integer representing the unique group ID. If the resulting user
             set is empty after filtering out invalid user IDs, returns `-1`.
         """
-        _users = frozenset({user for user in users if user != -1})
+        _users = frozenset(user for user in users if user != -1)
         if not _users:
             return -1
-        if _users in self.group_cache:
-            return self.group_cache[_users]
+        # A single get replaces the separate membership check and index, probing the cache once per call.
+        cached_id = self.group_cache.get(_users)
+        if cached_id is not None:
+            return cached_id
         id: int = next(self.counter)
         self.group_cache[_users] = id
         return id
\ No newline at end of file
@@ -1,16 +1,22 @@
-import functools
-from multiprocessing import Pool, Manager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from pathlib import Path
+import math
 import os
 import re
-import hashlib
-from typing import Set, List, Dict
+from typing import Set, List, Dict, Iterable, Iterator
 import traceback
 
 import pandas as pd
+import pyarrow as pa
+import xxhash
 
 from email_pipeline.pipeline import EmailPipeline
 from src.buffer.buffer_manager import EmailBufferManager
+from src.cache.bloom_filter import SharedBloomFilter
+from src.cache.canon_cache import CanonCache
+from src.data_object.email_file import EmailFile
 from src.data_object.processed_email import ProcessedEmail
 from user_pipeline.pipeline import UserPipeline
 from group_pipeline.pipeline import GroupPipeline
@@ -21,113 +27,169 @@ import quopri
 EMAIL_TABLE_OUTPUT_PATH = Path(__file__).parent.parent / "output" / "email_table.parquet"
 USER_TABLE_OUTPUT_PATH = Path(__file__).parent.parent / "output" / "user_table.parquet"
 GROUP_TABLE_OUTPUT_PATH = Path(__file__).parent.parent / "output" / "group_table.parquet"
+# Canonicalized emails kept between runs, so unchanged files are not re-parsed.
+CANON_CACHE_PATH = Path(__file__).parent.parent / "output" / "canon_cache.bin"
 
-def parse_and_canonicalize(file_path) -> str | None:
-    try:
-        with open("\\\\?\\" + str(file_path.resolve()), "rb") as file:
-            email = file.read().decode()
+# Number of files handed to a worker at a time, and processed by the email pipeline as one batch.
+FILE_BATCH_SIZE = 256
+
+# Headers that differ between copies of the same email, stripped to form the canonical version. Applied to the raw bytes.
+_CANON_FILTER = re.compile(rb"(X-Folder:|X-Origin:|X-FileName:|Message-ID:).*\n")
+
+# Bump when parse_and_canonicalize changes how the canonical bytes are produced, so cached entries are discarded. The
+# filter pattern is part of the tag, so edits to it invalidate the cache without a bump.
+CANON_FORMAT_VERSION = 1
+_CANON_FORMAT_TAG = f"{CANON_FORMAT_VERSION}:{_CANON_FILTER.pattern!r}"
+
+# Deduplication filters shared by all worker processes, attached by _init_worker. Each worker tests and sets the bits
+# in shared memory directly, so duplicates are caught across workers without a round trip to a manager process. The
+# message cache is held by the worker's email pipeline.
+_file_cache: SharedBloomFilter | None = None
+_email_pipeline: EmailPipeline | None = None
 
-            canon_filter = r"(X-Folder:|X-Origin:|X-FileName:|Message-ID:).*\n"
+def _init_worker(file_cache_name: str, message_cache_name: str):
+    global _file_cache, _email_pipeline
+    _file_cache = SharedBloomFilter(name=file_cache_name)
+    _email_pipeline = EmailPipeline(SharedBloomFilter(name=message_cache_name))
 
-            canon_email = re.sub(canon_filter, "", email)
-            canon_email_encoded = quopri.decodestring(canon_email)
-            canon_email = decode_str(canon_email_encoded)
-            return canon_email
+def read_file(file_path: Path, canon_cache: CanonCache) -> EmailFile:
+    """
+    Reads an email file, or its canonical version from the cache if the file is unchanged since it was cached. This is
+    the only disk-bound step, so it runs on the reader threads rather than in the worker processes.
+    """
+    try:
+        full_path = "\\\\?\\" + str(file_path.resolve())
+        mtime_ns = os.stat(full_path).st_mtime_ns
+        cached = canon_cache.get(str(file_path), mtime_ns)
+        if cached:
+            packed, canon_size = cached
+            return EmailFile(file_path, mtime_ns, packed, canon_size)
+        with open(full_path, "rb") as file:
+            return EmailFile(file_path, mtime_ns, file.read())
     except Exception as e:
-        print(f"Error while parsing {file_path}. Details: {e}")
-        print(traceback.format_exc())
-        return None
+        print(f"Error while reading {file_path}. Details: {e}")
+        return EmailFile(file_path, 0, None)
+
+def read_files(file_paths: Iterable[Path], canon_cache: CanonCache, max_workers: int = 32, read_ahead: int = 4096) -> Iterator[EmailFile]:
+    """
+    Reads files on a thread pool, yielding them in order. At most read_ahead reads are in flight, so the whole dataset
+    is never held in memory while the worker processes catch up.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for file_path in file_paths:
+            pending.append(executor.submit(read_file, file_path, canon_cache))
+            if len(pending) >= read_ahead:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
-def process_single_file(file_path, message_cache, file_cache, cache_lock) -> List[ProcessedEmail] | None:
+def parse_and_canonicalize(file_path, email_bytes: bytes) -> tuple[bytes, str] | None:
+    """
+    Returns the canonical email both as the quoted-printable decoded bytes, which are hashed directly, and as the
+    decoded text used by the email pipeline.
+    """
     try:
-        # Parse and canonicalize (no shared state needed)
-        canon_email = parse_and_canonicalize(file_path)
+        canon_email_encoded = quopri.decodestring(_CANON_FILTER.sub(b"", email_bytes))
+        canon_email = decode_str(canon_email_encoded)
         if not canon_email:
             return None
-
-        hash_obj = hashlib.md5()
-        hash_obj.update(canon_email.encode("utf-8"))
-        hash_obj = hash_obj.hexdigest()
-        with cache_lock:
-            if hash_obj in file_cache:
-                return None
-            file_cache[hash_obj] = True
-
-        # Process with shared cache (lock managed internally)
-        email_manager = EmailPipeline()  # Stateless now!
-        processed_emails = email_manager.process_file_contents(
-            canon_email,
-            message_cache,
-            cache_lock
-        )
-        return processed_emails
+        return canon_email_encoded, canon_email
     except Exception as e:
-        print(f"Exception caught. Details: {e}")
+        print(f"Error while parsing {file_path}. Details: {e}")
+        print(traceback.format_exc())
         return None
 
+def process_file_batch(files: List[EmailFile]) -> tuple[pa.RecordBatch, List[EmailFile]]:
+    """
+    Canonicalizes and deduplicates a batch of files, then runs the new ones through the email pipeline together so it
+    can extract fields across the whole batch at once.
+    :return: The processed emails as a record batch, and the files canonicalized in this batch, packed for the main
+    process to cache.
+    """
+    canon_emails: List[str] = []
+    to_cache: List[EmailFile] = []
+    for email_file in files:
+        if email_file.contents is None:
+            continue
+        if email_file.canon_size is not None:
+            canon_bytes = CanonCache.unpack(email_file.contents, email_file.canon_size)
+            canon_email = decode_str(canon_bytes)
+            if not canon_email:
+                continue
+        else:
+            canonicalized = parse_and_canonicalize(email_file.path, email_file.contents)
+            if not canonicalized:
+                continue
+            canon_bytes, canon_email = canonicalized
+            to_cache.append(EmailFile(email_file.path, email_file.mtime_ns, CanonCache.pack(canon_bytes), len(canon_bytes)))
+
+        hash_obj = xxhash.xxh3_128_hexdigest(canon_bytes)
+        if _file_cache.test_and_set(hash_obj):
+            continue
+        canon_emails.append(canon_email)
+
+    processed_emails: List[ProcessedEmail] = []
+    for file_emails in _email_pipeline.process_batch(canon_emails):
+        if file_emails:
+            processed_emails.extend(file_emails)
+    return ProcessedEmail.to_record_batch(processed_emails), to_cache
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    """
+    Groups an iterable into lists of at most the given size.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
 def run():
     root = Path(__file__).parent.parent / "input" / "maildir"
     _remove_files(root)
 
-    if os.path.exists(EMAIL_TABLE_OUTPUT_PATH):
-        os.remove(EMAIL_TABLE_OUTPUT_PATH)
-
     file_paths = list(root.rglob("*."))
 
     user_manager = UserPipeline()
     group_manager = GroupPipeline()
-    email_buffer_manager = EmailBufferManager(batch_size=1000, output_path=EMAIL_TABLE_OUTPUT_PATH)
-
-    with Manager() as manager:
-        file_cache = manager.dict()
-        msg_cache = manager.dict()
-        lock = manager.Lock()
-
-        worker = functools.partial(process_single_file, message_cache=msg_cache, file_cache=file_cache, cache_lock=lock)
-
-        with Pool(processes=None) as pool:
-            results = pool.imap_unordered(worker, file_paths, chunksize=1000)
-
-            for processed_emails in tqdm(results, total=len(file_paths)):
-                if not processed_emails:
-                    continue
-                # Accounting for aliases that use space deliminators instead of ", " to reformat for user pipeline
-                # ingestion.
-
-                for processed_email in processed_emails:
-                    users: Set[int] = set()
-                    for alias in processed_email.aliases:
-                        if not alias or not alias.strip():
-                            continue
-                        if alias.count(",") > 3:
-                            # Assume spaces are the deliminators, as for a single alias to have many , means the regex failed.
-                            for alias_ in alias.split(", "):
-                                if "@" in alias_:
-                                    users.add(user_manager.get_user_id(alias_))
-                                    continue
-                                users.add(user_manager.get_user_id(alias_.replace(" ", ", ")))
-                        else:
-                            _id = user_manager.get_user_id(alias)
-                            users.add(_id)
-                    group_id = group_manager.get_group_id(users)
-                    sender_id = user_manager.get_user_id_from_set(processed_email.sender) if processed_email.sender else -1
-
-                    email_data = {
-                        "email_hash": processed_email.email_hash,
-                        "group_id": group_id,
-                        "subject": processed_email.subject,
-                        "date": processed_email.date,
-                        "norm_date": processed_email.norm_date,
-                        "sender_id": sender_id,
-                        "parent_hash": processed_email.parent_hash
-                    }
-                    email_buffer_manager.add_emails([email_data])
-
-    # --- Final Flush ---
-    # Ensure any remaining emails in the buffer are written to the file.
-    print("Flushing final email batch...")
-    email_buffer_manager.flush()
+    with EmailBufferManager(batch_size=65536, output_path=EMAIL_TABLE_OUTPUT_PATH) as email_buffer_manager:
+        # The shared memory blocks are freed even if the run fails, rather than leaking until the interpreter exits, and
+        # the cache index is written so the entries appended before a failure are not orphaned.
+        with (CanonCache(CANON_CACHE_PATH, _CANON_FORMAT_TAG) as canon_cache,
+              SharedBloomFilter() as file_cache, SharedBloomFilter() as message_cache):
+            with Pool(processes=None, initializer=_init_worker, initargs=(file_cache.name, message_cache.name)) as pool:
+                # Files are read ahead on threads, so the worker processes only spend their time on CPU-bound parsing.
+                file_batches = _batched(read_files(file_paths, canon_cache), FILE_BATCH_SIZE)
+                results = pool.imap_unordered(process_file_batch, file_batches)
+
+                for email_batch, canonicalized_files in tqdm(results, total=math.ceil(len(file_paths) / FILE_BATCH_SIZE)):
+                    for email_file in canonicalized_files:
+                        canon_cache.put(str(email_file.path), email_file.mtime_ns, email_file.contents, email_file.canon_size)
+                    if not email_batch.num_rows:
+                        continue
+                    # User ids depend on every alias seen so far, so they are assigned here, one email at a time.
+                    group_ids: List[int] = []
+                    sender_ids: List[int] = []
+                    for email_aliases, sender in zip(email_batch.column("aliases").to_pylist(),
+                                                     email_batch.column("sender").to_pylist()):
+                        # The aliases were already reformatted for ingestion by the workers.
+                        users: Set[int] = {user_manager.get_user_id(alias) for alias in email_aliases}
+                        group_ids.append(group_manager.get_group_id(users))
+                        sender_ids.append(user_manager.get_user_id_from_set(set(sender)) if sender else -1)
+
+                    email_buffer_manager.add_batch(pa.RecordBatch.from_arrays(
+                        email_batch.columns + [pa.array(group_ids, pa.int64()), pa.array(sender_ids, pa.int64())],
+                        names=email_batch.schema.names + ["group_id", "sender_id"]
+                    ))
+
+        # --- Final Flush ---
+        # Leaving the context flushes any remaining emails in the buffer and closes the writer.
+        print("Flushing final email batch...")
 
     _write_users_to_parquet(user_manager.users, USER_TABLE_OUTPUT_PATH)
     _write_groups_to_parquet(group_manager.group_cache, GROUP_TABLE_OUTPUT_PATH)
@@ -160,7 +222,7 @@ def _write_groups_to_parquet(groups: Dict[frozenset, int], file_path: Path):
             "user_ids": list(users)
         })
     df = pd.DataFrame(group_data)
-    df.to_parquet(file_path, engine='pyarrow', index=False)
+    df.to_parquet(file_path, engine='pyarrow', compression="zstd", compression_level=3, index=False)
     print(f"Wrote group table with {len(group_data)} records to {file_path}")
 
 def _write_users_to_parquet(users: Dict[int, UserProfile], file_path: Path):
@@ -173,11 +235,12 @@ def _write_users_to_parquet(users: Dict[int, UserProfile], file_path: Path):
             "user_id": user_id,
             "first_name": profile.first_name,
             "last_name": profile.last_name,
+            "initial": profile.initial,
             "generated_aliases": list(profile.generated_aliases),
             "aliases": list(profile.aliases)
         })
     df = pd.DataFrame(user_data)
-    df.to_parquet(file_path, engine='pyarrow', index=False)
+    df.to_parquet(file_path, engine='pyarrow', compression="zstd", compression_level=3, index=False)
     print(f"Wrote user table with {len(user_data)} records to {file_path}")
 
 
@@ -1,31 +1,60 @@
 from pathlib import Path
+import itertools
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
-import re
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, get_start_method
+from . import _helpers as helpers
 
 
-def _filter_invalid_aliases(aliases_set):
+def _filter_invalid_aliases(aliases):
     """
-    Filters a frozenset of aliases, keeping only valid ones.
+    Filters each user's aliases, keeping only valid ones.
     A valid alias is a string that meets the specified length criteria,
     which depends on whether it contains an "@" symbol.
     This is critical to prevent a single invalid alias from deleting an entire user.
+    The whole column is exploded and filtered at once, rather than looping over each user's aliases in Python.
+    :param aliases: The aliases column, indexed by user_id.
+    :return: A frozenset of valid aliases per user, with an empty frozenset for users left without any.
     """
-    aliases_set = frozenset(aliases_set)
+    exploded = aliases.explode()
+    # Non-string entries, including the NaN left by users without aliases, have no length and fail the comparison.
+    max_lengths = np.where(exploded.str.contains("@", regex=False, na=False), 60, 35)
+    valid = exploded[exploded.str.len().astype("float64").le(max_lengths)]
+    return valid.groupby(level=0).agg(frozenset).astype(object).reindex(aliases.index, fill_value=frozenset())
 
-    valid_aliases = set()
-    for alias in aliases_set:
-        if isinstance(alias, str):
-            # Apply the new length logic
-            if "@" in alias:
-                if len(alias) <= 60:
-                    valid_aliases.add(alias)
-            else:
-                if len(alias) <= 35:
-                    valid_aliases.add(alias)
-
-    return frozenset(valid_aliases)
+def _generate_aliases(user_df):
+    """
+    Generates the enron-related aliases of every user at once, in the same formats as the user pipeline's
+    _generate_aliases, with one string concatenation per format over the whole table.
+    :param user_df: The user table, with first_name, last_name and initial columns.
+    :return: A frozenset of generated aliases per user, empty for users without both a first and last name.
+    """
+    first_name = user_df["first_name"].fillna("")
+    last_name = user_df["last_name"].fillna("")
+    initial = user_df["initial"].fillna("")
+    has_name = first_name.ne("") & last_name.ne("")
+    has_initial = has_name & initial.ne("")
+    generated_aliases = pd.concat([
+        (first_name + "." + last_name + "@enron.com")[has_name],
+        (first_name.str[0] + last_name + "@enron.com")[has_name],
+        (first_name + "." + initial + "." + last_name + "@enron.com")[has_initial],
+        (initial + ".." + last_name + "@enron.com")[has_initial],
+    ])
+    return (generated_aliases.groupby(level=0).agg(frozenset).astype(object)
+            .reindex(user_df.index, fill_value=frozenset()))
+
+def _to_list_array(aliases):
+    """
+    Converts a column of alias collections to an Arrow list<string> array. All aliases are flattened into a single
+    values array with offsets taken from the collection sizes, instead of converting each one to a Python list.
+    """
+    offsets = np.zeros(len(aliases) + 1, dtype=np.int32)
+    np.cumsum(aliases.map(len).to_numpy(), out=offsets[1:])
+    values = pa.array(list(itertools.chain.from_iterable(aliases)), type=pa.string())
+    return pa.ListArray.from_arrays(pa.array(offsets), values)
 
 def _update_df(user_df, matches_dict):
     """
@@ -36,47 +65,123 @@ def _update_df(user_df, matches_dict):
         return user_df
 
     child_ids_to_drop = list(matches_dict.keys())
+    parent_ids = pd.unique(pd.Series(list(matches_dict.values())))
 
+    # The aliases of every user involved are read in one lookup, and the merged sets written back in one assignment,
+    # rather than a .loc and an .at per match. The unions are folded in match order, as a child can itself be the
+    # parent of an earlier match, in which case it passes on the aliases it has gathered so far.
+    aliases = user_df.loc[pd.Index(child_ids_to_drop).union(parent_ids), "aliases"].to_dict()
     for child_id, parent_id in matches_dict.items():
-        child_aliases = user_df.loc[child_id, "aliases"]
-        parent_aliases = user_df.loc[parent_id, "aliases"]
+        aliases[parent_id] = aliases[parent_id] | aliases[child_id]
 
-        child_aliases = frozenset(child_aliases)
-        parent_aliases = frozenset(parent_aliases)
-
-        user_df.at[parent_id, "aliases"] = parent_aliases | child_aliases
+    user_df.loc[parent_ids, "aliases"] = pd.Series([aliases[parent_id] for parent_id in parent_ids], index=parent_ids,
+                                                   dtype=object)
 
     return user_df.drop(child_ids_to_drop)
 
 
-def _match_worker(chunk, name_df):
+# Below this many generated aliases, the Stage 1 join runs in process, as it finishes before a pool could start.
+_PARALLEL_JOIN_MIN_ROWS = 1_000_000
+
+
+def _join_bucket(generated_bucket, alias_bucket):
     """
-    Worker function for multiprocessing. Finds regex matches in a chunk of data.
+    Worker function for multiprocessing. Joins one hash bucket of generated aliases to the same bucket of alias owners.
     """
-    matches_dict = {}
+    return generated_bucket.merge(alias_bucket, on="alias")
+
+
+def _join_generated_aliases(generated_aliases, alias_owners, num_cores):
+    """
+    Joins generated aliases to the users holding them as real aliases. Large joins are split by a hash of the alias
+    into one bucket per core, so every match falls within a single bucket, and the buckets are joined in parallel.
+    """
+    if len(generated_aliases) < _PARALLEL_JOIN_MIN_ROWS:
+        return _join_bucket(generated_aliases, alias_owners)
+
+    generated_buckets = pd.util.hash_array(generated_aliases["alias"].to_numpy(dtype=object)) % num_cores
+    alias_buckets = pd.util.hash_array(alias_owners["alias"].to_numpy(dtype=object)) % num_cores
+    bucket_pairs = [(generated_aliases[generated_buckets == bucket], alias_owners[alias_buckets == bucket])
+                    for bucket in range(num_cores)]
+    with Pool(processes=num_cores) as pool:
+        return pd.concat(pool.starmap(_join_bucket, bucket_pairs))
+
+
+# The parent matching index, attached to each worker process by _init_match_worker, or inherited when forked.
+_MATCH_INDEX = None
+
 
-    # Pre-compile patterns from name_df outside the inner loop
-    parent_patterns = []
-    for parent_id, parent_row in name_df.iterrows():
+def _build_match_index(name_df):
+    """
+    Indexes the named users once, so each alias is matched with lookups rather than two regexes per parent.
+    Pattern 1 (<first_initial><last_name>, the whole alias) becomes a dict keyed on the exact alias. Pattern 2
+    (<first_name> then <last_name> anywhere) is keyed on last_name, found by looking up each substring of the alias
+    whose length matches a known last name. Parents are kept in name_df order, as the first matching parent wins.
+    """
+    initial_index = {}
+    last_name_index = {}
+    for rank, (parent_id, parent_row) in enumerate(name_df.iterrows()):
         first_name = parent_row["first_name"]
         last_name = parent_row["last_name"]
+        initial_index.setdefault(f"{first_name[0]}{last_name}", []).append((rank, parent_id))
+        last_name_index.setdefault(last_name, []).append((rank, parent_id, first_name))
+    last_name_lengths = sorted({len(last_name) for last_name in last_name_index})
+    return initial_index, last_name_index, last_name_lengths
+
 
-        # Pattern 1: <first_initial><last_name>
-        pattern_1 = re.compile(f"^{first_name[0]}{last_name}$")
-        # Pattern 2: <first_name> then <last_name> anywhere
-        pattern_2 = re.compile(f"{first_name}.*{last_name}")
+def _init_match_worker(match_index):
+    global _MATCH_INDEX
+    _MATCH_INDEX = match_index
 
-        parent_patterns.append((parent_id, [pattern_1, pattern_2]))
 
-    for child_id, row in chunk.iterrows():
-        child_aliases = row["aliases"]
+def _first_then_last(alias, first_name, last_name):
+    """
+    Equivalent to re.search(f"{first_name}.*{last_name}", alias), where . does not cross a newline.
+    """
+    for line in alias.split("\n"):
+        start = line.find(first_name)
+        if start != -1 and line.find(last_name, start + len(first_name)) != -1:
+            return True
+    return False
+
+
+def _find_parent(alias, child_id):
+    """
+    Finds the first parent matching an alias, skipping the child itself.
+    :return: The parent's user_id, or None if no parent matches.
+    """
+    initial_index, last_name_index, last_name_lengths = _MATCH_INDEX
+    # Candidate parents as (rank, parent_id); the lowest rank is the parent the regex scan would reach first.
+    # As with the regex's $, a single trailing newline is ignored by the exact match.
+    exact_alias = alias[:-1] if alias.endswith("\n") else alias
+    candidates = [c for c in initial_index.get(exact_alias, ()) if c[1] != child_id]
+    last_names = set()
+    for length in last_name_lengths:
+        # The lengths are sorted, so no longer last name can fit in the alias either.
+        if length > len(alias):
+            break
+        for start in range(len(alias) - length + 1):
+            substring = alias[start:start + length]
+            if substring in last_name_index:
+                last_names.add(substring)
+    for last_name in last_names:
+        for rank, parent_id, first_name in last_name_index[last_name]:
+            if parent_id != child_id and _first_then_last(alias, first_name, last_name):
+                candidates.append((rank, parent_id))
+    return min(candidates)[1] if candidates else None
+
+
+def _match_worker(chunk):
+    """
+    Worker function for multiprocessing. Finds the first matching parent for each user in a chunk of data.
+    :param chunk: The aliases column of a chunk of users, indexed by user_id.
+    """
+    matches_dict = {}
+    for child_id, child_aliases in zip(chunk.index, chunk):
         for alias in child_aliases:
-            for parent_id, patterns in parent_patterns:
-                if patterns[0].search(alias) or patterns[1].search(alias):
-                    if child_id != parent_id:
-                        matches_dict[child_id] = parent_id
-                        break
-            if child_id in matches_dict:
+            parent_id = _find_parent(alias, child_id)
+            if parent_id is not None:
+                matches_dict[child_id] = parent_id
                 break
     return matches_dict
 
@@ -91,15 +196,25 @@ def run(paths: dict):
         print("User map path already exists, skipping...")
         return
 
-    user_df = pd.read_parquet(USER_TABLE_OUTPUT_PATH).set_index("user_id")
+    # The generated aliases are regenerated in bulk from the names, rather than relying on the sets built one user at a
+    # time during ingestion, so they are not read. User tables written before the initial was stored keep their
+    # generated aliases as loaded.
+    user_columns = pq.read_schema(USER_TABLE_OUTPUT_PATH).names
+    if "initial" in user_columns:
+        user_columns.remove("generated_aliases")
+    user_df = pd.read_parquet(USER_TABLE_OUTPUT_PATH, columns=user_columns).set_index("user_id")
+    if "initial" in user_columns:
+        user_df["generated_aliases"] = _generate_aliases(user_df)
 
     # Stage 1: Initial exact alias matching (single-threaded)
 
-    user_df["aliases"] = user_df["aliases"].apply(_filter_invalid_aliases)
+    user_df["aliases"] = _filter_invalid_aliases(user_df["aliases"])
 
     # Identify users for deletion: those with no name and no valid aliases
-    is_name_empty = user_df["first_name"].str.strip().eq("") & user_df["last_name"].str.strip().eq("")
-    has_no_aliases = user_df["aliases"].apply(lambda x: not x)
+    first_name = user_df["first_name"].str.strip()
+    last_name = user_df["last_name"].str.strip()
+    is_name_empty = first_name.eq("") & last_name.eq("")
+    has_no_aliases = user_df["aliases"].map(len).eq(0)
 
     to_delete = user_df[is_name_empty & has_no_aliases].index.to_list()
 
@@ -113,20 +228,25 @@ def run(paths: dict):
     has_name_mask = (user_df["first_name"] != "") & (user_df["last_name"] != "")
     name_df = user_df[has_name_mask]
 
-    alias_to_id_map = {}
-    for user_id, row in user_df.iterrows():
-        for alias in row["aliases"]:
-            alias_to_id_map[alias] = user_id
+    # Each generated alias is joined to the user holding it as a real alias. An alias held by several users belongs to
+    # the last of them.
+    alias_owners = (user_df["aliases"].explode().dropna().rename("alias").reset_index()
+                    .drop_duplicates("alias", keep="last")
+                    .rename(columns={"user_id": "child_id"}))
+    generated_aliases = (name_df["generated_aliases"].explode().dropna().rename("alias").reset_index()
+                         .rename(columns={"user_id": "parent_id"})
+                         .reset_index(names="position"))
+    num_cores = cpu_count()
+    joined = _join_generated_aliases(generated_aliases, alias_owners, num_cores).sort_values("position", kind="stable")
+    joined = joined[joined["parent_id"] != joined["child_id"]]
 
+    # Only the joined rows are walked, in name_df order, as a user already matched as a child of an earlier parent is
+    # not used as a parent itself.
     matches_dict_1 = {}
-    for user_id, row in name_df.iterrows():
-        if user_id in matches_dict_1:
+    for parent_id, child_id in zip(joined["parent_id"], joined["child_id"]):
+        if parent_id in matches_dict_1:
             continue
-        for gen_alias in row["generated_aliases"]:
-            if gen_alias in alias_to_id_map:
-                child_id = alias_to_id_map[gen_alias]
-                if user_id != child_id:
-                    matches_dict_1[child_id] = user_id
+        matches_dict_1[child_id] = parent_id
 
     print(f"Stage 1: Found {len(matches_dict_1)} initial matches.")
 
@@ -141,13 +261,23 @@ def run(paths: dict):
     print(f"Stage 2: Starting multiprocessing for {len(no_name_df_updated)} users...")
 
     # Split no_name_df into chunks for parallel processing
-    num_cores = cpu_count()
     chunk_size = len(no_name_df_updated) // num_cores + 1
-    chunks = [no_name_df_updated[i:i + chunk_size] for i in range(0, len(no_name_df_updated), chunk_size)]
-
-    with Pool(processes=num_cores) as pool:
+    # Only the aliases are matched, so only they are sent to the workers.
+    no_name_aliases = no_name_df_updated["aliases"]
+    chunks = [no_name_aliases[i:i + chunk_size] for i in range(0, len(no_name_aliases), chunk_size)]
+
+    # The index is built once here and handed to each worker, instead of each worker compiling patterns per parent.
+    match_index = _build_match_index(name_df_updated)
+    if get_start_method() == "fork":
+        # Forked workers inherit the index from this process's memory, so it is never pickled.
+        _init_match_worker(match_index)
+        pool_args = {}
+    else:
+        # Spawned workers receive the index once each, when they start.
+        pool_args = {"initializer": _init_match_worker, "initargs": (match_index,)}
+    with Pool(processes=num_cores, **pool_args) as pool:
         # Map the worker function to each chunk
-        results = pool.starmap(_match_worker, [(chunk, name_df_updated) for chunk in chunks])
+        results = pool.map(_match_worker, chunks)
 
     matches_dict_2 = {}
     for result_dict in results:
@@ -165,19 +295,25 @@ def run(paths: dict):
     df_to_delete = pd.DataFrame.from_dict(matches_dict_1, orient="index", columns=["parent_id"])
     df_to_delete.index.name = "child_id"
     df_to_delete = df_to_delete.reset_index()
-    df_to_delete.to_parquet(USER_MAP_TABLE_OUTPUT_PATH, engine='pyarrow', index=False)
+    for column in ["child_id", "parent_id"]:
+        df_to_delete[column] = helpers._to_int32(df_to_delete[column])
+    df_to_delete.to_parquet(USER_MAP_TABLE_OUTPUT_PATH, engine='pyarrow', compression="zstd", compression_level=3, index=False)
 
     # Append the list of users with no name/alias to the to_delete table
     to_delete.extend(df_to_delete["child_id"].to_list())
 
     final_to_delete_df = pd.DataFrame(to_delete, columns=["user_id"])
-    final_to_delete_df.to_parquet(TO_DELETE_OUTPUT_PATH, engine="pyarrow", index=False)
-
-    # Convert the 'aliases' column to a list before writing to Parquet to avoid ArrowInvalid error
-    user_df["aliases"] = user_df["aliases"].apply(list)
-
-    user_df = user_df.reset_index()
-    user_df.to_parquet(USER_TABLE_UPDATED_OUTPUT_PATH, engine="pyarrow", index=False)
+    final_to_delete_df["user_id"] = helpers._to_int32(final_to_delete_df["user_id"])
+    final_to_delete_df.to_parquet(TO_DELETE_OUTPUT_PATH, engine="pyarrow", compression="zstd", compression_level=3, index=False)
+
+    # Arrow cannot convert frozensets, so the alias columns are built as list<string> arrays directly and appended to
+    # the rest of the table. Parquet dictionary encodes the alias strings within each column chunk.
+    user_table_df = user_df.drop(columns=["generated_aliases", "aliases"]).reset_index()
+    user_table_df["user_id"] = helpers._to_int32(user_table_df["user_id"])
+    user_table = pa.Table.from_pandas(user_table_df, preserve_index=False)
+    user_table = user_table.append_column("generated_aliases", _to_list_array(user_df["generated_aliases"]))
+    user_table = user_table.append_column("aliases", _to_list_array(user_df["aliases"]))
+    pq.write_table(user_table, USER_TABLE_UPDATED_OUTPUT_PATH, compression="zstd", compression_level=3)
     print("Updated user table and user map created successfully.")
 
 
@@ -1,6 +1,14 @@
 import pandas as pd
+import pyarrow as pa
 from pathlib import Path
 from collections import defaultdict
+from . import _helpers as helpers
+
+# The member lists are written as int32 explicitly, as Arrow would infer int64 from the Python ints in each set.
+_GROUPS_UPDATED_SCHEMA = pa.schema([
+    pa.field("group_id", pa.int32()),
+    pa.field("user_ids", pa.list_(pa.int32())),
+])
 
 def run(paths: dict):
     """
@@ -18,64 +26,58 @@ def run(paths: dict):
     GROUPS_UPDATED_PATH = paths["groups_updated"]
     GROUP_REMAP_PATH = paths["group_remap"]
     
-    group_df = pd.read_parquet(GROUP_TABLE_PATH)
-    user_map_df = pd.read_parquet(USER_MAP_TABLE_PATH)
-    to_delete_df = pd.read_parquet(TO_DELETE_TABLE_PATH)
+    group_df = pd.read_parquet(GROUP_TABLE_PATH, columns=["group_id", "user_ids"])
+    user_map_df = pd.read_parquet(USER_MAP_TABLE_PATH, columns=["child_id", "parent_id"])
+    to_delete_df = pd.read_parquet(TO_DELETE_TABLE_PATH, columns=["user_id"])
+    # The ids are narrowed to int32 before any lookups or joins on them.
+    group_df["group_id"] = helpers._to_int32(group_df["group_id"])
+    to_delete_df["user_id"] = helpers._to_int32(to_delete_df["user_id"])
+    for column in ["child_id", "parent_id"]:
+        user_map_df[column] = helpers._to_int32(user_map_df[column])
 
     # --- 2. Create Lookup Maps for Efficiency ---
     print("Creating lookup maps...")
     to_delete_set = set(to_delete_df["user_id"])
-    user_remap_dict = pd.Series(user_map_df.parent_id.values, index=user_map_df.child_id).to_dict()
+    # Like a dict built from the table, a repeated child takes its last parent. The parent is nullable Int32, so the
+    # users without a parent stay integers through the join below instead of becoming float64 NaNs.
+    user_remap_df = user_map_df.drop_duplicates("child_id", keep="last").astype({"parent_id": "Int32"})
 
     # --- 3. Update Group Memberships ---
     print("Updating group memberships...")
     
-    def update_user_list(user_ids):
-        """
-        Applies deletions and remaps to a list of user IDs from a group.
-        Returns a frozenset of the updated user IDs for easy comparison.
-        """
-        updated_users = set()
-        for user_id in user_ids:
-            if user_id in to_delete_set:
-                continue  # Skip deleted users
-            
-            # If the user_id is a 'child', replace it with the 'parent'
-            mapped_id = user_remap_dict.get(user_id, user_id)
-            updated_users.add(mapped_id)
-        
-        return frozenset(updated_users)
-
-    # Apply the update function to the 'user_ids' column
-    group_df["updated_user_ids"] = group_df["user_ids"].apply(update_user_list)
+    # The memberships of all groups are flattened into one series, so deletions and remaps are applied in a single
+    # vectorized pass rather than a Python loop per group. Empty groups explode to NaN and are dropped with them.
+    user_ids = helpers._to_int32(group_df["user_ids"].explode().dropna())
+    user_ids = user_ids[~user_ids.isin(to_delete_set)]
+    # If a user_id is a 'child', replace it with the 'parent', using a hash join on the int32 ids.
+    memberships = (user_ids.rename("child_id").rename_axis("group_row").reset_index()
+                   .merge(user_remap_df, on="child_id", how="left"))
+    user_ids = pd.Series(memberships["parent_id"].fillna(memberships["child_id"]).to_numpy(dtype="int32"),
+                         index=memberships["group_row"])
+    # A frozenset per group for easy comparison; groups left without users get an empty one.
+    group_df["updated_user_ids"] = (user_ids.groupby(level=0).agg(frozenset).astype(object)
+                                    .reindex(group_df.index, fill_value=frozenset()))
 
     # --- 4. Deduplicate Groups ---
     print("Deduplicating groups...")
     
-    seen_groups = {}  # Maps a frozenset of user_ids to the first group_id seen
-    group_remap = {}  # Maps a redundant/empty group_id to its canonical group_id or -1
-    
-    for index, row in group_df.iterrows():
-        group_id = row["group_id"]
-        user_set = row["updated_user_ids"]
-        
-        # Check if the group is now empty.
-        if not user_set:
-            group_remap[group_id] = -1 # Mark for deletion
-            continue
+    # Groups with identical memberships are grouped together, and each one maps to the first group_id of its group.
+    # Groups that are now empty are marked for deletion with -1.
+    is_empty = group_df["updated_user_ids"].map(len).eq(0)
+    canonical_group_ids = (group_df.loc[~is_empty].groupby("updated_user_ids", sort=False)["group_id"]
+                           .transform("first")
+                           .reindex(group_df.index, fill_value=-1))
 
-        if user_set in seen_groups:
-            canonical_group_id = seen_groups[user_set]
-            if group_id != canonical_group_id:
-                group_remap[group_id] = canonical_group_id
-        else:
-            seen_groups[user_set] = group_id
+    # Maps a redundant/empty group_id to its canonical group_id or -1, in table order.
+    is_remapped = canonical_group_ids.ne(group_df["group_id"])
+    group_remap = dict(zip(group_df.loc[is_remapped, "group_id"], canonical_group_ids[is_remapped]))
             
     # --- 5. Generate Final Outputs ---
     print("Generating final output files...")
     
-    # Create a DataFrame for the group remapping
-    group_remap_df = pd.DataFrame(list(group_remap.items()), columns=["old_group_id", "new_group_id"])
+    # Create a DataFrame for the group remapping, keeping the ids as int32
+    group_remap_df = pd.DataFrame({"old_group_id": pd.Series(list(group_remap.keys()), dtype="int32"),
+                                   "new_group_id": pd.Series(list(group_remap.values()), dtype="int32")})
     
     # Get the list of all group IDs that will be replaced or deleted
     obsolete_group_ids = set(group_remap.keys())
@@ -89,8 +91,8 @@ def run(paths: dict):
     updated_group_df["user_ids"] = updated_group_df["user_ids"].apply(list)
     
     # Write to Parquet
-    updated_group_df.to_parquet(GROUPS_UPDATED_PATH, index=False)
-    group_remap_df.to_parquet(GROUP_REMAP_PATH, index=False)
+    updated_group_df.to_parquet(GROUPS_UPDATED_PATH, schema=_GROUPS_UPDATED_SCHEMA, compression="zstd", compression_level=3, index=False)
+    group_remap_df.to_parquet(GROUP_REMAP_PATH, compression="zstd", compression_level=3, index=False)
     
     print(f"Processing complete.")
     print(f"Saved updated groups to: {GROUPS_UPDATED_PATH}")
@@ -1,7 +1,34 @@
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from . import _helpers as helpers
 
-def run(paths: dict):
+def _remap_ids(ids, remap_df, old_column, new_column):
+    """
+    Replaces each id found in the remap table's old column with its new id, leaving any other id unchanged.
+    The ids are looked up positionally in an index of the old ids, so the column keeps its integer dtype throughout,
+    rather than mapping through a dict and upcasting to float64 for the NaNs of ids that are not remapped.
+    """
+    ids = ids.to_numpy()
+    if remap_df.empty:
+        return ids
+    # Like a dict built from the table, a repeated old id takes its last new id.
+    remap_df = remap_df.drop_duplicates(old_column, keep="last")
+    positions = pd.Index(remap_df[old_column]).get_indexer(ids)
+    new_ids = remap_df[new_column].to_numpy(dtype=ids.dtype)
+    return np.where(positions >= 0, new_ids[positions], ids)
+
+def load_email_table(paths: dict) -> pd.DataFrame:
+    """
+    Reads the email table produced by the main pipeline. It does not depend on the earlier post-processing steps, so
+    it can be loaded while they run.
+    """
+    email_df = pd.read_parquet(paths["email_table"])
+    for column in ["sender_id", "group_id"]:
+        email_df[column] = helpers._to_int32(email_df[column])
+    return email_df
+
+def run(paths: dict, email_df: pd.DataFrame | None = None):
     """
     This is the final script in the post-processing pipeline.
     1. It updates the sender_id field based on user merges.
@@ -9,25 +36,28 @@ def run(paths: dict):
     3. It removes rows corresponding to deleted (empty) groups.
     4. It drops duplicate (email_hash, group_id) rows that are created during remapping.
     5. It generates the final, normalized junction tables.
+    :param email_df: The email table, if already loaded by load_email_table. Otherwise it is read here.
     """
     # --- 1. Load Data ---
     print("Loading data...")
-    email_df = pd.read_parquet(paths["email_table"])
-    group_remap_df = pd.read_parquet(paths["group_remap"])
-    groups_updated_df = pd.read_parquet(paths["groups_updated"])
-    user_map_df = pd.read_parquet(paths["user_map_table"])
+    if email_df is None:
+        email_df = load_email_table(paths)
+    group_remap_df = pd.read_parquet(paths["group_remap"], columns=["old_group_id", "new_group_id"])
+    groups_updated_df = pd.read_parquet(paths["groups_updated"], columns=["group_id", "user_ids"])
+    user_map_df = pd.read_parquet(paths["user_map_table"], columns=["child_id", "parent_id"])
+    # The ids are narrowed to int32 before any lookups, as are the email table's in load_email_table.
+    for df, columns in [(group_remap_df, ["old_group_id", "new_group_id"]), (groups_updated_df, ["group_id"]),
+                        (user_map_df, ["child_id", "parent_id"])]:
+        for column in columns:
+            df[column] = helpers._to_int32(df[column])
 
     # --- 2. Apply User Remapping to sender_id ---
     print("Applying user remapping to the 'sender_id' field...")
-    user_remap_dict = pd.Series(user_map_df.parent_id.values, index=user_map_df.child_id).to_dict()
-    
-    email_df["sender_id"] = email_df["sender_id"].map(user_remap_dict).fillna(email_df["sender_id"])
-    email_df["sender_id"] = email_df["sender_id"].astype(int)
+    email_df["sender_id"] = _remap_ids(email_df["sender_id"], user_map_df, "child_id", "parent_id")
 
     # --- 3. Apply Group Remapping ---
     print("Applying group remapping to the email table...")
-    group_remap_dict = pd.Series(group_remap_df.new_group_id.values, index=group_remap_df.old_group_id).to_dict()
-    email_df["group_id"] = email_df["group_id"].map(group_remap_dict).fillna(email_df["group_id"]).astype(int)
+    email_df["group_id"] = _remap_ids(email_df["group_id"], group_remap_df, "old_group_id", "new_group_id")
 
     # --- 4. Remove Deleted Groups ---
     initial_rows = len(email_df)
@@ -46,20 +76,22 @@ def run(paths: dict):
     print("Saving final, cleaned tables...")
     
     # Save the final email table
-    email_df.to_parquet(paths["final_email_table"], index=False)
+    email_df.to_parquet(paths["final_email_table"], compression="zstd", compression_level=3, index=False)
     print(f"  - Saved updated email table to: {paths['final_email_table']}")
 
-    # Create and save the email-to-group junction table
-    email_group_junction_df = email_df[["email_hash", "group_id"]].copy().drop_duplicates()
-    email_group_junction_df.to_parquet(paths["email_group_junction"], index=False)
+    # Create and save the email-to-group junction table. The pairs are already unique after step 5.
+    email_group_junction_df = email_df[["email_hash", "group_id"]]
+    email_group_junction_df.to_parquet(paths["email_group_junction"], compression="zstd", compression_level=3, index=False)
     print(f"  - Saved email-group junction table to: {paths['email_group_junction']}")
 
-    # Create and save the email-to-user junction table
-    junction_df = pd.merge(email_df, groups_updated_df, on="group_id", how="inner")
-    junction_df = junction_df.explode("user_ids")
-    junction_df = junction_df[["email_hash", "user_ids"]].rename(columns={"user_ids": "user_id"})
+    # Create and save the email-to-user junction table. The groups are exploded to one row per member first, so the
+    # merge only carries the two key columns rather than every email column and each group's list of users.
+    group_members_df = (groups_updated_df[["group_id", "user_ids"]].explode("user_ids").dropna()
+                        .rename(columns={"user_ids": "user_id"}))
+    group_members_df["user_id"] = helpers._to_int32(group_members_df["user_id"])
+    junction_df = email_group_junction_df.merge(group_members_df, on="group_id", how="inner")[["email_hash", "user_id"]]
     junction_df.drop_duplicates(inplace=True)
-    junction_df.to_parquet(paths["email_user_junction"], index=False)
+    junction_df.to_parquet(paths["email_user_junction"], compression="zstd", compression_level=3, index=False)
     print(f"  - Saved email-user junction table to: {paths['email_user_junction']}")
 
     print("Post-processing complete.")
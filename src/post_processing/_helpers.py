@@ -0,0 +1,17 @@
+import numpy as np
+import pandas as pd
+
+_INT32 = np.iinfo(np.int32)
+
+
+def _to_int32(ids: pd.Series) -> pd.Series:
+    """
+    Narrows a column of user or group ids to int32, halving the bytes hashed and moved by every join and lookup on it.
+    Ids are assigned sequentially from 0 and -1 is the only sentinel, so they fit unless a table outgrows 2**31 rows.
+    :param ids: The ids, of any integer dtype.
+    :return: The ids as int32.
+    """
+    if not ids.empty and (ids.max() > _INT32.max or ids.min() < _INT32.min):
+        raise ValueError(f"Column {ids.name} holds ids outside of the int32 range "
+                         f"({ids.min()} to {ids.max()}), so it cannot be narrowed.")
+    return ids.astype(np.int32)
@@ -1,5 +1,6 @@
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import importlib
 
@@ -89,16 +90,23 @@ def run_pipeline():
     user_postprocessing.run(paths)
     print(f"<<< Step 1 finished in {time.time() - start_time:.2f} seconds. >>>")
 
-    # --- Step 2: Group Consolidation ---
-    print("\n>>> Running Step 2: Group Post-Processing...")
-    start_time = time.time()
-    group_postprocessing.run(paths)
-    print(f"<<< Step 2 finished in {time.time() - start_time:.2f} seconds. >>>")
+    # The email table is only needed by step 3, but does not depend on steps 1 or 2, so it is read on a background
+    # thread while step 2 runs. It is not started before step 1, as that step forks worker processes.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        email_table = executor.submit(email_postprocessing.load_email_table, paths)
+
+        # --- Step 2: Group Consolidation ---
+        print("\n>>> Running Step 2: Group Post-Processing...")
+        start_time = time.time()
+        group_postprocessing.run(paths)
+        print(f"<<< Step 2 finished in {time.time() - start_time:.2f} seconds. >>>")
+
+        email_df = email_table.result()
 
     # --- Step 3: Final Email Table Updates ---
     print("\n>>> Running Step 3: Email Post-Processing...")
     start_time = time.time()
-    email_postprocessing.run(paths)
+    email_postprocessing.run(paths, email_df=email_df)
     print(f"<<< Step 3 finished in {time.time() - start_time:.2f} seconds. >>>")
 
     # --- Step 4: Cleanup ---
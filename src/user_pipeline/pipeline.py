@@ -1,9 +1,16 @@
 from typing import Dict, Set
 from src.data_object.user_profile import UserProfile
 import re
+import sys
 import itertools
 from . import _helpers as helpers
 
+_EMAIL_ALIAS = re.compile(r"^([\w\.]+)@([\w\.]+)$")
+_FIRST_LAST = re.compile(r"^(\w+)\.(\w+)$")
+_FIRST_INITIAL_LAST = re.compile(r"^(\w+)\.(\w)\.(\w+)$")
+_ANGLE_BRACKETS = re.compile(r"<[^>]+>")
+_NON_ALPHA = re.compile(r'[^a-zA-Z]')
+
 class UserPipeline:
     def __init__(self):
         self.users: Dict[int, UserProfile] = {}
@@ -18,7 +25,8 @@ class UserPipeline:
         if not alias or not alias.strip():
             raise ValueError("Alias cannot be blank.")
         
-        alias = alias.lower().strip()
+        # Interned, as the alias lookup holds millions of entries repeating the same few strings.
+        alias = sys.intern(alias.lower().strip())
         
         if alias in self.alias_lookup:
             return self.alias_lookup[alias]
@@ -32,7 +40,7 @@ class UserPipeline:
         finds/creates/updates user profiles.
         """
         # 1. Clean aliases.
-        cleaned_aliases = {a.lower().strip() for a in aliases if a}
+        cleaned_aliases = {sys.intern(a.lower().strip()) for a in aliases if a}
         if not cleaned_aliases:
             raise ValueError("Cannot reconcile an empty set of aliases.")
 
@@ -67,24 +75,23 @@ class UserPipeline:
     def _parse_alias(self, alias: str) -> Dict:
         """Parses an alias string and returns a dictionary of its components."""
         # Try parsing as an email first
-        email_filter = r"^([\w\.]+)@([\w\.]+)$"
-        email_re = re.match(email_filter, alias)
+        email_re = _EMAIL_ALIAS.match(alias)
         if email_re:
             name_part = email_re.group(1)
             domain_part = email_re.group(2)
             if domain_part == "enron.com" and not '..' in name_part:
                 dot_count = name_part.count('.')
                 if dot_count == 1:
-                    name_re = re.match(r"^(\w+)\.(\w+)$", name_part)
+                    name_re = _FIRST_LAST.match(name_part)
                     if name_re:
                         return {"first_name": name_re.group(1), "initial": "", "last_name": name_re.group(2)}
                 elif dot_count == 2:
-                    name_re = re.match(r"^(\w+)\.(\w)\.(\w+)$", name_part)
+                    name_re = _FIRST_INITIAL_LAST.match(name_part)
                     if name_re:
                         return {"first_name": name_re.group(1), "initial": name_re.group(2), "last_name": name_re.group(3)}
         
         # Try parsing as "last, first"
-        alias = re.sub(r"<[^>]+>", "", alias) # clean angle brackets
+        alias = _ANGLE_BRACKETS.sub("", alias) # clean angle brackets
         split = alias.split(", ")
         if len(split) == 2:
             last_name, first_name_part = split
@@ -97,9 +104,9 @@ class UserPipeline:
             if len(first_name_spaces) > 1:
                 initial = first_name_spaces[1].strip()
 
-            last_name = re.sub(r'[^a-zA-Z]', '', last_name)
-            first_name = re.sub(r'[^a-zA-Z]', '', first_name)
-            initial = re.sub(r'[^a-zA-Z]', '', initial)
+            last_name = _NON_ALPHA.sub('', last_name)
+            first_name = _NON_ALPHA.sub('', first_name)
+            initial = _NON_ALPHA.sub('', initial)
 
             if first_name and last_name:
                 return {"first_name": first_name, "last_name": last_name, "initial": initial}
@@ -124,6 +131,7 @@ class UserPipeline:
             id=user_id,
             first_name=first_name,
             last_name=last_name,
+            initial=initial,
             generated_aliases=frozenset(generated_aliases),
             aliases=frozenset(all_aliases)
         )
@@ -145,6 +153,7 @@ class UserPipeline:
             profile.first_name = first_name
             profile.last_name = last_name
             initial = parsed_info["initial"]
+            profile.initial = initial
             generated_aliases = helpers._generate_aliases(first_name, last_name, initial)
             profile.generated_aliases = profile.generated_aliases.union(generated_aliases)
 